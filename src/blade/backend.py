@@ -35,6 +35,20 @@ def protoc_import_path_option(incs):
     return ' '.join(['-I=%s' % inc for inc in incs])
 
 
+def _zip_compresslevel_option():
+    """The `--compresslevel` builtin tool option from the `BLADE_ZIP_LEVEL` environment variable.
+
+    It is passed in the command line rather than read by the builtin tool, so changing
+    it causes ninja to rebuild the affected zip files.
+    """
+    level = os.environ.get('BLADE_ZIP_LEVEL')
+    if not level:
+        return ''
+    if not level.isdigit() or int(level) > 9:
+        console.fatal('Invalid BLADE_ZIP_LEVEL "%s", it should be an integer in range 0-9' % level)
+    return '--compresslevel=%d ' % int(level)
+
+
 class _NinjaFileHeaderGenerator(object):
     """Generate global declarations and definitions for build script.
 
@@ -471,7 +485,7 @@ class _NinjaFileHeaderGenerator(object):
                            command=self._builtin_command('python_library', suffix=args),
                            description='PYTHON LIBRARY ${out}')
         args = ('--basedir=${basedir} --exclusions=${exclusions} --mainentry=${mainentry} '
-                '--pybin=${out} ${in}')
+                '%s--pybin=${out} ${in}' % _zip_compresslevel_option())
         self.generate_rule(name='pythonbinary',
                            command=self._builtin_command('python_binary', suffix=args),
                            description='PYTHON BINARY ${out}')
@@ -532,7 +546,7 @@ class _NinjaFileHeaderGenerator(object):
                            description='YACC ${in}')
 
     def generate_package_rules(self):
-        args = '${out} ${in} ${entries}'
+        args = '%s${out} ${in} ${entries}' % _zip_compresslevel_option()
         self.generate_rule(name='package',
                            command=self._builtin_command('package', suffix=args),
                            description='PACKAGE ${out}')
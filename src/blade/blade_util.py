@@ -50,11 +50,18 @@ def md5sum_str(content):
     return md5sum_bytes(content.encode('utf-8'))
 
 
+_MD5_FILE_BLOCK_SIZE = 1024 * 1024
+
+
 def md5sum_file(file_name):
     """Calculate md5sum of a file. """
     with open(file_name, 'rb') as f:
-        digest = md5sum_bytes(f.read())
-    return digest
+        if hasattr(md5, 'file_digest'):  # Python 3.11+, reads the file in C
+            return md5.file_digest(f, 'md5').hexdigest()
+        m = md5.md5()
+        for block in iter(lambda: f.read(_MD5_FILE_BLOCK_SIZE), b''):
+            m.update(block)
+    return m.hexdigest()
 
 
 def md5sum(obj):
@@ -217,6 +224,15 @@ def environ_add_path(env, key, path):
         env[key] = path
 
 
+def which(cmd):
+    """Find the full path of an executable in PATH, return None if not found"""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        full_path = os.path.join(path, cmd)
+        if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+            return full_path
+    return None
+
+
 def cpu_count():
     try:
         import multiprocessing  # pylint: disable=import-outside-toplevel
@@ -27,11 +27,17 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import ast
 import fnmatch
 import getpass
+import hashlib
+import json
 import os
+import re
 import shutil
 import socket
+import struct
+import subprocess
 import sys
 import tarfile
 import textwrap
@@ -69,47 +75,105 @@ def parse_command_line(argv):
     return options, args
 
 
+_SCM_TEMPLATE = textwrap.dedent('''\
+    /* This file was generated by blade */
+    extern "C" {
+    namespace binary_version {
+    extern const int kSvnInfoCount = 1;
+    extern const char* const kSvnInfo[] = {"%s\\n"};
+    extern const int kScmInfoCount = 1;
+    extern const char* const kScmInfo[] = {"%s\\n"};
+    extern const char kBuildType[] = "%s";
+    extern const char kBuildTime[] = "%s";
+    extern const char kBuilderName[] = "%s";
+    extern const char kHostName[] = "%s";
+    extern const char kCompiler[] = "%s";
+    }}''')
+
+
 def generate_scm(scm, revision, url, profile, compiler, args):
     """Generate `scm.c` file"""
     version = '%s@%s' % (url, revision)
     with open(scm, 'w') as f:
-        f.write(textwrap.dedent(r'''\
-                /* This file was generated by blade */
-                extern "C" {
-                namespace binary_version {
-                extern const int kSvnInfoCount = 1;
-                extern const char* const kSvnInfo[] = {"%s\n"};
-                extern const int kScmInfoCount = 1;
-                extern const char* const kScmInfo[] = {"%s\n"};
-                extern const char kBuildType[] = "%s";
-                extern const char kBuildTime[] = "%s";
-                extern const char kBuilderName[] = "%s";
-                extern const char kHostName[] = "%s";
-                extern const char kCompiler[] = "%s";
-                }}''') % (version,
-                          version,
-                          profile,
-                          time.asctime(),
-                          getpass.getuser(),
-                          socket.gethostname(),
-                          compiler))
+        f.write(_SCM_TEMPLATE % (version,
+                                 version,
+                                 profile,
+                                 time.asctime(),
+                                 getpass.getuser(),
+                                 socket.gethostname(),
+                                 compiler))
 
 
 _PACKAGE_MANIFEST = 'MANIFEST.TXT'
 
 
+_COPY_BLOCK_SIZE = 1024 * 1024
+
+
+class _HashingReader(object):
+    """File object wrapper which calculates the md5 of the data read through it"""
+
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._md5.update(data)
+        return data
+
+    def hexdigest(self):
+        # Consume the remaining data, if any, to get the digest of the whole file
+        while self.read(_COPY_BLOCK_SIZE):
+            pass
+        return self._md5.hexdigest()
+
+
 def archive_package_sources(package, sources, destinations):
-    """Content of the `MANIFEST.TXT` file in the target zip file"""
+    """Content of the `MANIFEST.TXT` file in the target zip file.
+
+    `package(source, destination, fileobj)` should archive the source by reading
+    from the fileobj, so the md5 is calculated without reading the file again.
+    """
     manifest = []
     for i, s in enumerate(sources):
-        package(s, destinations[i])
-        manifest.append('%s %s' % (blade_util.md5sum_file(s), destinations[i]))
+        with open(s, 'rb') as f:
+            reader = _HashingReader(f)
+            package(s, destinations[i], reader)
+            manifest.append('%s %s' % (reader.hexdigest(), destinations[i]))
     return manifest
 
 
-def generate_zip_package(path, sources, destinations):
-    zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
-    manifest = archive_package_sources(zip.write, sources, destinations)
+def _open_deflated_zip(path, mode, compresslevel=None):
+    """Open a zip file for writing with DEFLATED method.
+
+    The compress level is only supported in python 3.7+ and ignored in older versions.
+    """
+    if compresslevel is not None and sys.version_info >= (3, 7):
+        return zipfile.ZipFile(path, mode, zipfile.ZIP_DEFLATED, compresslevel=compresslevel)
+    return zipfile.ZipFile(path, mode, zipfile.ZIP_DEFLATED)
+
+
+def _set_zip_compression(zinfo, zip):
+    """Compress the member with the default compression of the zip file"""
+    zinfo.compress_type = zip.compression
+    if hasattr(zip, 'compresslevel'):  # Python 3.7+
+        zinfo._compresslevel = zip.compresslevel  # pylint: disable=protected-access
+
+
+def generate_zip_package(path, sources, destinations, compresslevel=None):
+    zip = _open_deflated_zip(path, 'w', compresslevel)
+
+    def package(source, destination, fileobj):
+        if sys.version_info < (3, 6):  # No writing mode of ZipFile.open
+            zip.write(source, destination)
+            return
+        zinfo = zipfile.ZipInfo.from_file(source, destination)
+        _set_zip_compression(zinfo, zip)
+        with zip.open(zinfo, 'w') as dst:
+            shutil.copyfileobj(fileobj, dst, _COPY_BLOCK_SIZE)
+
+    manifest = archive_package_sources(package, sources, destinations)
     zip.writestr(_PACKAGE_MANIFEST, '\n'.join(manifest) + '\n')
     zip.close()
 
@@ -122,20 +186,66 @@ _TAR_WRITE_MODES = {
     'tbz': 'w:bz2',
 }
 
+# Longest first, so 'tar.gz' is matched before 'tar'
+_TAR_SUFFIXES = tuple(sorted(_TAR_WRITE_MODES, key=len, reverse=True))
+
+
+# Multithreaded compressors which are compatible with the tarfile write modes
+_TAR_PARALLEL_COMPRESSORS = {
+    'w:gz': ['pigz'],
+    'w:bz2': ['pbzip2'],
+}
+
+
+def _open_tar_compressor(path, mode):
+    """Start a parallel compressor writing to path, return None if not available"""
+    compressor = _TAR_PARALLEL_COMPRESSORS.get(mode)
+    if not compressor or not blade_util.which(compressor[0]):
+        return None
+    with open(path, 'wb') as f:
+        return subprocess.Popen(compressor, stdin=subprocess.PIPE, stdout=f)
+
 
 def generate_tar_package(path, sources, destinations, suffix):
     mode = _TAR_WRITE_MODES[suffix]
-    tar = tarfile.open(path, mode, dereference=True)
-    manifest = archive_package_sources(tar.add, sources, destinations)
-    manifest_path = '%s.MANIFEST' % path
-    m = open(manifest_path, 'w')
-    m.write('\n'.join(manifest) + '\n\n')
-    m.close()
-    tar.add(manifest_path, _PACKAGE_MANIFEST)
-    tar.close()
+    # Only the tar stream is generated here, the compressing is much slower and
+    # can be offloaded to a multithreaded compressor if it is installed.
+    compressor = _open_tar_compressor(path, mode)
+    if compressor:
+        tar = tarfile.open(mode='w|', fileobj=compressor.stdin, dereference=True)
+    else:
+        tar = tarfile.open(path, mode, dereference=True)
 
+    def package(source, destination, fileobj):
+        tar.addfile(tar.gettarinfo(source, destination), fileobj)
 
-def generate_package(args):
+    succeeded = False
+    try:
+        manifest = archive_package_sources(package, sources, destinations)
+        manifest_path = '%s.MANIFEST' % path
+        m = open(manifest_path, 'w')
+        m.write('\n'.join(manifest) + '\n\n')
+        m.close()
+        tar.add(manifest_path, _PACKAGE_MANIFEST)
+        tar.close()
+        succeeded = True
+    finally:
+        # Don't let the compressor finish a valid looking file from a partial tar stream
+        if compressor and not succeeded:
+            compressor.kill()
+            compressor.wait()
+            tar.fileobj.closed = True  # Discard the buffered data of the broken stream
+    if compressor:
+        compressor.stdin.close()
+        returncode = compressor.wait()
+        if returncode != 0:
+            console.error('%s: %s failed with return code %d' % (
+                path, _TAR_PARALLEL_COMPRESSORS[mode][0], returncode))
+            return 1
+    return None
+
+
+def generate_package(args, compresslevel=''):
     path = args[0]
     manifest = args[1:]
     assert len(manifest) % 2 == 0
@@ -143,79 +253,105 @@ def generate_package(args):
     sources = manifest[:middle]
     destinations = manifest[middle:]
     if path.endswith('.zip'):
-        generate_zip_package(path, sources, destinations)
+        level = int(compresslevel) if compresslevel else None
+        return generate_zip_package(path, sources, destinations, level)
     else:
-        for ext in _TAR_WRITE_MODES:
-            if path.endswith(ext):
-                suffix = ext
-                break
-        generate_tar_package(path, sources, destinations, suffix)
+        suffix = next((s for s in _TAR_SUFFIXES if path.endswith('.' + s)), None)
+        assert suffix, 'Unknown package type "%s"' % path
+        return generate_tar_package(path, sources, destinations, suffix)
 
 
 def generate_securecc_object(args):
     obj, phony_obj = args
     if not os.path.exists(obj):
-        shutil.copy(phony_obj, obj)
+        # Use copy2 to keep the mtime, which is checked to skip hashing next time
+        shutil.copy2(phony_obj, obj)
+        return
+    stat, phony_stat = os.stat(obj), os.stat(phony_obj)
+    if stat.st_size != phony_stat.st_size:
+        shutil.copy2(phony_obj, obj)
+    elif stat.st_mtime == phony_stat.st_mtime:
+        # Same size and mtime, it was copied from the phony object
+        pass
     else:
         digest = blade_util.md5sum_file(obj)
         phony_digest = blade_util.md5sum_file(phony_obj)
         if digest != phony_digest:
-            shutil.copy(phony_obj, obj)
+            shutil.copy2(phony_obj, obj)
+
+
+_RESOURCE_INDEX_HEADER_PROLOGUE = textwrap.dedent('''\
+    // This file was automatically generated by blade
+    #ifndef {0}
+    #define {0}
+
+    #ifdef __cplusplus
+    extern "C" {{
+    #endif
+
+    #ifndef BLADE_RESOURCE_TYPE_DEFINED
+    #define BLADE_RESOURCE_TYPE_DEFINED
+    struct BladeResourceEntry {{
+        const char* name;
+        const char* data;
+        unsigned int size;
+    }};
+    #endif''')
+
+
+_RESOURCE_INDEX_SOURCE_PROLOGUE = textwrap.dedent('''\
+    // This file was automatically generated by blade
+    #include "{0}"
+
+    const struct BladeResourceEntry {1}[] = {{''')
+
+
+_RESOURCE_INDEX_SOURCE_EPILOGUE = textwrap.dedent('''\
+    }};
+    const unsigned {0}_len = {1};''')
+
+
+_RESOURCE_INDEX_HEADER_EPILOGUE = textwrap.dedent('''\
+    // Resource index
+    extern const struct BladeResourceEntry {0}[];
+    extern const unsigned {0}_len;
+
+    #ifdef __cplusplus
+    }}  // extern "C"
+    #endif
+
+    #endif  // {1}''')
 
 
 def _generate_resource_index(targets, sources, name, path):
     """Generate resource index description file for a cc resource library"""
     header, source = targets
+    full_name = blade_util.regular_variable_name(os.path.join(path, name))
+    guard_name = 'BLADE_RESOURCE_%s_H_' % full_name.upper()
+    index_name = 'RESOURCE_INDEX_%s' % full_name
+
+    # Build the whole contents in memory and write each file at once
+    h_parts = [_RESOURCE_INDEX_HEADER_PROLOGUE.format(guard_name)]
+    c_parts = [_RESOURCE_INDEX_SOURCE_PROLOGUE.format(header, index_name)]
+
+    # Resolve the dirs once, relpath calls getcwd for each relative path
+    cwd = os.getcwd()
+    start = os.path.join(cwd, path)
+    for s in sources:
+        entry_var = blade_util.regular_variable_name(s)
+        entry_name = os.path.relpath(os.path.join(cwd, s), start)
+        entry_size = os.stat(s).st_size
+        h_parts.append('// %s\n'
+                       'extern const char RESOURCE_%s[%d];\n'
+                       'extern const unsigned RESOURCE_%s_len;\n' % (
+                           entry_name, entry_var, entry_size, entry_var))
+        c_parts.append('    { "%s", RESOURCE_%s, %s },\n' % (entry_name, entry_var, entry_size))
+
+    c_parts.append(_RESOURCE_INDEX_SOURCE_EPILOGUE.format(index_name, len(sources)))
+    h_parts.append(_RESOURCE_INDEX_HEADER_EPILOGUE.format(index_name, guard_name))
     with open(header, 'w') as h, open(source, 'w') as c:
-        full_name = blade_util.regular_variable_name(os.path.join(path, name))
-        guard_name = 'BLADE_RESOURCE_%s_H_' % full_name.upper()
-        index_name = 'RESOURCE_INDEX_%s' % full_name
-
-        h.write(textwrap.dedent('''\
-                // This file was automatically generated by blade
-                #ifndef {0}
-                #define {0}
-
-                #ifdef __cplusplus
-                extern "C" {{
-                #endif
-
-                #ifndef BLADE_RESOURCE_TYPE_DEFINED
-                #define BLADE_RESOURCE_TYPE_DEFINED
-                struct BladeResourceEntry {{
-                    const char* name;
-                    const char* data;
-                    unsigned int size;
-                }};
-                #endif''').format(guard_name))
-        c.write(textwrap.dedent('''\
-                // This file was automatically generated by blade
-                #include "{0}"
-
-                const struct BladeResourceEntry {1}[] = {{''').format(header, index_name))
-
-        for s in sources:
-            entry_var = blade_util.regular_variable_name(s)
-            entry_name = os.path.relpath(s, path)
-            entry_size = os.path.getsize(s)
-            h.write('// %s\n' % entry_name)
-            h.write('extern const char RESOURCE_%s[%d];\n' % (entry_var, entry_size))
-            h.write('extern const unsigned RESOURCE_%s_len;\n' % entry_var)
-            c.write('    { "%s", RESOURCE_%s, %s },\n' % (entry_name, entry_var, entry_size))
-
-        c.write(textwrap.dedent('''\
-                }};
-                const unsigned {0}_len = {1};''').format(index_name, len(sources)))
-        h.write(textwrap.dedent('''\
-                // Resource index
-                extern const struct BladeResourceEntry {0}[];
-                extern const unsigned {0}_len;
-
-                #ifdef __cplusplus
-                }}  // extern "C"
-                #endif
-
-                #endif  // {1}''').format(index_name, guard_name))
+        h.write(''.join(h_parts))
+        c.write(''.join(c_parts))
 
 
 def generate_resource_index(args):
@@ -258,56 +394,57 @@ def generate_java_jar(args):
 def generate_java_resource(args):
     assert len(args) % 2 == 0
     middle = len(args) // 2
-    targets = args[:middle]
-    sources = args[middle:]
-    for i in range(middle):
-        shutil.copy(sources[i], targets[i])
+    for target, source in zip(args[:middle], args[middle:]):
+        shutil.copy(source, target)
 
 
 def _get_all_test_class_names_in_jar(jar):
     """Returns a list of test class names in the jar file."""
     test_class_names = []
-    zip_file = zipfile.ZipFile(jar, 'r')
-    name_list = zip_file.namelist()
-    for name in name_list:
-        basename = os.path.basename(name)
-        # Exclude inner class and Test.class
-        if (basename.endswith('Test.class') and
-                len(basename) > len('Test.class') and
-                not '$' in basename):
-            class_name = name.replace('/', '.')[:-6]  # Remove .class suffix
-            test_class_names.append(class_name)
-    zip_file.close()
+    with zipfile.ZipFile(jar, 'r') as zip_file:
+        for info in zip_file.infolist():
+            name = info.filename
+            basename = name[name.rfind('/') + 1:]
+            # Exclude inner class and Test.class
+            if (basename.endswith('Test.class') and
+                    len(basename) > len('Test.class') and
+                    '$' not in basename):
+                class_name = name[:-6].replace('/', '.')  # Remove .class suffix
+                test_class_names.append(class_name)
     return test_class_names
 
 
 def _jacoco_test_coverage_flag(jacocoagent, packages_under_test):
     if packages_under_test and jacocoagent:
         jacocoagent = os.path.abspath(jacocoagent)
-        packages = packages_under_test.split(':')
+        packages = [p for p in packages_under_test.split(':') if p]
+        includes = '.*:'.join(packages) + '.*' if packages else ''
         options = [
-            'includes=%s' % ':'.join([p + '.*' for p in packages if p]),
+            'includes=%s' % includes,
             'output=file',
         ]
         return '-javaagent:%s=%s' % (jacocoagent, ','.join(options))
     return ''
 
 
+_JAVA_TEST_SCRIPT_TEMPLATE = textwrap.dedent('''\
+    #!/bin/sh
+    # Auto generated wrapper shell script by blade
+
+    if [ -n "$BLADE_COVERAGE" ]; then
+        coverage_options="%s"
+    fi
+
+    exec java $coverage_options -classpath %s %s %s $@''')
+
+
 def generate_java_test(script, main_class, jacocoagent, packages_under_test, args):
     jars = args
     test_jar = jars[0]
     test_classes = ' '.join(_get_all_test_class_names_in_jar(test_jar))
     with open(script, 'w') as f:
         coverage_flags = _jacoco_test_coverage_flag(jacocoagent, packages_under_test)
-        f.write(textwrap.dedent('''\
-                #!/bin/sh
-                # Auto generated wrapper shell script by blade
-
-                if [ -n "$BLADE_COVERAGE" ]; then
-                    coverage_options="%s"
-                fi
-
-                exec java $coverage_options -classpath %s %s %s $@''') % (
+        f.write(_JAVA_TEST_SCRIPT_TEMPLATE % (
                 coverage_flags, ':'.join(jars), main_class, test_classes))
     os.chmod(script, 0o755)
 
@@ -319,6 +456,15 @@ def generate_fat_jar(args):
     fatjar.generate_fat_jar(jar, args[1:])
 
 
+# Note that the manifest file must end with a new line or carriage return
+_ONE_JAR_MANIFEST_TEMPLATE = textwrap.dedent('''\
+    Manifest-Version: 1.0
+    Main-Class: com.simontuffs.onejar.Boot
+    One-Jar-Main-Class: %s
+
+    ''')
+
+
 def generate_one_jar(onejar, main_class, bootjar, args):
     # Assume the first jar is the main jar, others jars are dependencies.
     main_jar = args[0]
@@ -331,7 +477,7 @@ def generate_one_jar(onejar, main_class, bootjar, args):
     name_list = zip_file.namelist()
     for name in name_list:
         if not name.lower().endswith('manifest.mf'):  # Exclude manifest
-            onejar.writestr(name, zip_file.read(name))
+            _zip_copy(zip_file, name, onejar)
             jar_path_set.add(name)
     zip_file.close()
 
@@ -344,85 +490,90 @@ def generate_one_jar(onejar, main_class, bootjar, args):
 
     # Copy resources to the root of target onejar
     for jar in [main_jar] + jars:
-        jar = zipfile.ZipFile(jar, 'r')
-        jar_name_list = jar.namelist()
-        for name in jar_name_list:
-            if name.endswith('.class') or name.upper().startswith('META-INF'):
-                continue
-            if name not in jar_path_set:
-                jar_path_set.add(name)
-                onejar.writestr(name, jar.read(name))
-        jar.close()
+        with zipfile.ZipFile(jar, 'r') as jar:
+            for name in jar.namelist():
+                if name.endswith('.class') or name.upper().startswith('META-INF'):
+                    continue
+                if name not in jar_path_set:
+                    jar_path_set.add(name)
+                    _zip_copy(jar, name, onejar)
 
     # Manifest
-    # Note that the manifest file must end with a new line or carriage return
     onejar.writestr(os.path.join('META-INF', 'MANIFEST.MF'),
-                    textwrap.dedent('''\
-                            Manifest-Version: 1.0
-                            Main-Class: com.simontuffs.onejar.Boot
-                            One-Jar-Main-Class: %s
-
-                            ''') % main_class)
+                    _ONE_JAR_MANIFEST_TEMPLATE % main_class)
     onejar.close()
 
 
+_JAVA_BINARY_SCRIPT_TEMPLATE = textwrap.dedent('''\
+    #!/bin/sh
+    # Auto generated wrapper shell script by blade
+
+    jar=`dirname "$0"`/"%s"
+    if [ ! -f "$jar" ]; then
+      jar="%s"
+    fi
+
+    exec java -jar "$jar" $@
+    ''')
+
+
 def generate_java_binary(args):
     script, onejar = args
     basename = os.path.basename(onejar)
     fullpath = os.path.abspath(onejar)
     with open(script, 'w') as f:
-        f.write(textwrap.dedent('''\
-                #!/bin/sh
-                # Auto generated wrapper shell script by blade
+        f.write(_JAVA_BINARY_SCRIPT_TEMPLATE % (basename, fullpath))
+    os.chmod(script, 0o755)
 
-                jar=`dirname "$0"`/"%s"
-                if [ ! -f "$jar" ]; then
-                  jar="%s"
-                fi
 
-                exec java -jar "$jar" $@
-                ''') % (basename, fullpath))
-    os.chmod(script, 0o755)
+_SCALA_TEST_SCRIPT_TEMPLATE = textwrap.dedent('''\
+    #!/bin/sh
+    # Auto generated wrapper shell script by blade
+
+    if [ -n "$BLADE_COVERAGE" ]; then
+        coverage_options="%s"
+    fi
+
+    JAVACMD=%s exec %s "$coverage_options" -classpath %s %s $@
+    ''')
 
 
 def generate_scala_test(script, java, scala, jacocoagent, packages_under_test, args):
     jars = args
     test_jar = jars[0]
     test_class_names = _get_all_test_class_names_in_jar(test_jar)
-    scala, java = os.path.abspath(scala), os.path.abspath(java)
+    cwd = os.getcwd()
+    scala = os.path.normpath(os.path.join(cwd, scala))
+    java = os.path.normpath(os.path.join(cwd, java))
     java_args = ''
     coverage_flags = _jacoco_test_coverage_flag(jacocoagent, packages_under_test)
     if coverage_flags:
         java_args = '-J%s' % coverage_flags
     run_args = 'org.scalatest.run ' + ' '.join(test_class_names)
     with open(script, 'w') as f:
-        text = textwrap.dedent('''\
-                #!/bin/sh
-                # Auto generated wrapper shell script by blade
-
-                if [ -n "$BLADE_COVERAGE" ]; then
-                    coverage_options="%s"
-                fi
-
-                JAVACMD=%s exec %s "$coverage_options" -classpath %s %s $@
-                ''') % (java_args, java, scala, ':'.join(jars), run_args)
+        text = _SCALA_TEST_SCRIPT_TEMPLATE % (java_args, java, scala, ':'.join(jars), run_args)
         f.write(text)
     os.chmod(script, 0o755)
 
 
+_SHELL_TEST_SCRIPT_TEMPLATE = textwrap.dedent("""\
+    #!/bin/sh
+    # Auto generated wrapper shell script by blade
+
+    set -e
+
+    %s
+
+    """)
+
+
 def generate_shell_test(args):
     wrapper = args[0]
     scripts = args[1:]
+    cwd = os.getcwd()
     with open(wrapper, 'w') as f:
-        f.write(textwrap.dedent("""\
-                #!/bin/sh
-                # Auto generated wrapper shell script by blade
-
-                set -e
-
-                %s
-
-                """) % '\n'.join(['. %s' % os.path.abspath(s) for s in scripts]))
+        f.write(_SHELL_TEST_SCRIPT_TEMPLATE % '\n'.join(
+                ['. %s' % os.path.normpath(os.path.join(cwd, s)) for s in scripts]))
     os.chmod(wrapper, 0o755)
 
 
@@ -431,11 +582,86 @@ def generate_shell_testdata(args):
     testdata = args[1:]
     assert len(testdata) % 2 == 0
     middle = len(testdata) // 2
-    sources = testdata[:middle]
-    destinations = testdata[middle:]
+    # Same as os.path.abspath, but without calling getcwd for each path
+    cwd = os.getcwd()
     with open(path, 'w') as f:
-        for i in range(middle):
-            f.write('%s %s\n' % (os.path.abspath(sources[i]), destinations[i]))
+        for source, destination in zip(testdata[:middle], testdata[middle:]):
+            f.write('%s %s\n' % (os.path.normpath(os.path.join(cwd, source)), destination))
+
+
+def _copy_zip_info(info):
+    """Create a new ZipInfo with the name, size and attributes of the member"""
+    zinfo = zipfile.ZipInfo(info.filename, info.date_time)
+    zinfo.file_size = info.file_size
+    zinfo.comment = info.comment
+    zinfo.create_system = info.create_system
+    zinfo.internal_attr = info.internal_attr
+    zinfo.external_attr = info.external_attr
+    return zinfo
+
+
+def _zip_copy_raw(src_zip, info, dst_zip):
+    """Copy a compressed member to another zip file without decompressing and recompressing"""
+    # pylint: disable=protected-access
+    src_zip.fp.seek(info.header_offset)
+    # Validate the local file header as ZipFile.open does
+    header = src_zip.fp.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader:
+        raise zipfile.BadZipfile('Truncated file header of "%s"' % info.filename)
+    header = struct.unpack(zipfile.structFileHeader, header)
+    if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile('Bad magic number for file header of "%s"' % info.filename)
+    fname = src_zip.fp.read(header[zipfile._FH_FILENAME_LENGTH])
+    if not isinstance(info.orig_filename, bytes):  # Python 3 decodes the file names
+        fname = fname.decode('utf-8' if info.flag_bits & 0x800 else 'cp437')
+    if fname != info.orig_filename:
+        raise zipfile.BadZipfile('File name in directory "%s" and header "%s" differ' % (
+            info.orig_filename, fname))
+    # Skip the extra field to the start of the compressed data
+    src_zip.fp.seek(header[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+
+    zinfo = _copy_zip_info(info)
+    zinfo.compress_type = info.compress_type
+    # Sizes and CRC are known, so the data descriptor is not needed
+    zinfo.flag_bits = info.flag_bits & ~0x08
+    zinfo.CRC = info.CRC
+    zinfo.compress_size = info.compress_size
+    zinfo.header_offset = dst_zip.fp.tell()
+    dst_zip._writecheck(zinfo)
+
+    dst_zip.fp.write(zinfo.FileHeader())
+    remain = info.compress_size
+    while remain > 0:
+        data = src_zip.fp.read(min(remain, _COPY_BLOCK_SIZE))
+        if not data:
+            raise zipfile.BadZipfile('Truncated member "%s"' % info.filename)
+        dst_zip.fp.write(data)
+        remain -= len(data)
+    dst_zip.filelist.append(zinfo)
+    dst_zip.NameToInfo[zinfo.filename] = zinfo
+    dst_zip.start_dir = dst_zip.fp.tell()
+    dst_zip._didModify = True
+
+
+def _zip_copy_stream(src_zip, info, dst_zip):
+    """Copy a member to another zip file by streaming, without reading it into memory"""
+    # The known file_size lets zipfile decide whether zip64 is needed
+    zinfo = _copy_zip_info(info)
+    _set_zip_compression(zinfo, dst_zip)
+    with src_zip.open(info) as src, dst_zip.open(zinfo, 'w') as dst:
+        shutil.copyfileobj(src, dst, _COPY_BLOCK_SIZE)
+
+
+def _zip_copy(src_zip, name, dst_zip):
+    """Copy a member to another zip file, reuse the compressed data if possible"""
+    info = src_zip.getinfo(name)
+    # Encrypted members can't be copied raw
+    if info.compress_type == zipfile.ZIP_DEFLATED and not info.flag_bits & 0x01:
+        _zip_copy_raw(src_zip, info, dst_zip)
+    elif sys.version_info >= (3, 6):  # Writing mode of ZipFile.open
+        _zip_copy_stream(src_zip, info, dst_zip)
+    else:
+        dst_zip.writestr(name, src_zip.read(name))
 
 
 def generate_python_library(pylib, basedir, args):
@@ -444,37 +670,48 @@ def generate_python_library(pylib, basedir, args):
         digest = blade_util.md5sum_file(py)
         sources.append((py, digest))
     with open(pylib, 'w') as f:
-        print(str({
+        json.dump({
             'base_dir': basedir,
             'srcs': sources
-        }), file=f)
+        }, f)
+
+
+def _compile_python_exclusions(exclusions):
+    """Combine all the wildcard patterns into one regex, return None if there is no pattern"""
+    patterns = [fnmatch.translate(p) for p in exclusions.split(',') if p]
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:%s)' % p for p in patterns))
 
 
 def _is_python_excluded_path(filename, exclusions):
-    for exclusion in exclusions:
-        if fnmatch.fnmatch(filename, exclusion):
-            return True
-    return False
+    return exclusions is not None and exclusions.match(filename) is not None
 
 
 def _update_init_py_dirs(arcname, dirs, dirs_with_init_py):
-    dir = os.path.dirname(arcname)
-    if os.path.basename(arcname) == '__init__.py':
+    dir = arcname.rpartition('/')[0]
+    if arcname.endswith('/__init__.py') or arcname == '__init__.py':
         dirs_with_init_py.add(dir)
-    while dir:
+    # Once a dir is known, all its ancestors are known too
+    while dir and dir not in dirs:
         dirs.add(dir)
-        dir = os.path.dirname(dir)
+        dir = dir.rpartition('/')[0]
 
 
 def _pybin_add_pylib(pybin, libname, exclusions, dirs, dirs_with_init_py):
     with open(libname) as pylib:
-        data = eval(pylib.read())  # pylint: disable=eval-used
-        pylib_base_dir = data['base_dir']
-        for libsrc, digest in data['srcs']:
-            arcname = os.path.relpath(libsrc, pylib_base_dir)
-            if not _is_python_excluded_path(arcname, exclusions):
-                _update_init_py_dirs(arcname, dirs, dirs_with_init_py)
-                pybin.write(libsrc, arcname)
+        content = pylib.read()
+    try:
+        data = json.loads(content)
+    except ValueError:
+        # The python dict literal format generated by older versions of blade
+        data = ast.literal_eval(content)
+    pylib_base_dir = data['base_dir']
+    for libsrc, digest in data['srcs']:
+        arcname = os.path.relpath(libsrc, pylib_base_dir)
+        if not _is_python_excluded_path(arcname, exclusions):
+            _update_init_py_dirs(arcname, dirs, dirs_with_init_py)
+            pybin.write(libsrc, arcname)
 
 
 def _pybin_add_zip(pybin, libname, filter, exclusions, dirs, dirs_with_init_py):
@@ -484,7 +721,7 @@ def _pybin_add_zip(pybin, libname, filter, exclusions, dirs, dirs_with_init_py):
             if filter(name) and not _is_python_excluded_path(name, exclusions):
                 if dirs is not None and dirs_with_init_py is not None:
                     _update_init_py_dirs(name, dirs, dirs_with_init_py)
-                pybin.writestr(name, lib.read(name))
+                _zip_copy(lib, name, pybin)
 
 
 def _pybin_add_egg(pybin, libname, exclusions):
@@ -507,9 +744,19 @@ def _pybin_add_whl(pybin, libname, exclusions, dirs, dirs_with_init_py):
     _pybin_add_zip(pybin, libname, filter, exclusions, dirs, dirs_with_init_py)
 
 
-def generate_python_binary(pybin, basedir, exclusions, mainentry, args):
-    pybin_zip = zipfile.ZipFile(pybin, 'w', zipfile.ZIP_DEFLATED)
-    exclusions = exclusions.split(',')
+def generate_python_binary(pybin, basedir, exclusions, mainentry, args, compresslevel=''):
+    # Write bootstrap before zip, it is also a valid zip file.
+    # unzip will seek actually start until meet the zip magic number.
+    bootstrap = ('#!/bin/sh\n\n'
+                 'PYTHONPATH="$0:$PYTHONPATH" exec python -m "%s" "$@"\n') % mainentry
+    with open(pybin, 'wb') as f:
+        f.write(bootstrap.encode('utf-8'))
+    # Append mode on a non-zip file appends a new zip archive after its content.
+    # The fastest level is used by default, for mostly small python source files
+    # the higher levels are much slower but hardly reduce the size.
+    level = int(compresslevel) if compresslevel else 1
+    pybin_zip = _open_deflated_zip(pybin, 'a', level)
+    exclusions = _compile_python_exclusions(exclusions)
     dirs, dirs_with_init_py = set(), set()
     for arg in args:
         if arg.endswith('.pylib'):
@@ -527,16 +774,6 @@ def generate_python_binary(pybin, basedir, exclusions, mainentry, args):
         pybin_zip.writestr(os.path.join(dir, '__init__.py'), '')
     pybin_zip.writestr('__init__.py', '')
     pybin_zip.close()
-
-    with open(pybin, 'rb') as f:
-        zip_content = f.read()
-    # Insert bootstrap before zip, it is also a valid zip file.
-    # unzip will seek actually start until meet the zip magic number.
-    bootstrap = ('#!/bin/sh\n\n'
-                 'PYTHONPATH="$0:$PYTHONPATH" exec python -m "%s" "$@"\n') % mainentry
-    with open(pybin, 'wb') as f:
-        f.write(bootstrap)
-        f.write(zip_content)
     os.chmod(pybin, 0o755)
 
 